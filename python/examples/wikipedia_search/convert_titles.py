@@ -0,0 +1,27 @@
+"""
+Purpose:
+
+One-time conversion of the 'titles_to_id.pickle' dictionary into the
+memory-mapped title table used by the query examples (see title_table.py).
+
+Run this once after downloading 'titles_to_id.pickle'.
+"""
+
+import pickle
+from title_table import TitleTable
+
+# Filepath parameters
+path_to_titles = "./wiki_data/titles_to_id.pickle"
+path_to_title_table = "./wiki_data/titles"
+
+print('Loading article titles...')
+
+# Load dictionary mapping article titles to their vector index.
+with open(path_to_titles, "rb") as f:
+    title_to_idx = pickle.load(f)
+
+print('Writing title table for %d articles...' % len(title_to_idx))
+
+TitleTable.build(title_to_idx, path_to_title_table)
+
+print('Done')
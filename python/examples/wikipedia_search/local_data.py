@@ -0,0 +1,84 @@
+"""
+Purpose:
+
+Cached loaders for the local copies of the Wikipedia data used by the
+example scripts.
+
+The scripts are meant to be re-run repeatedly in an IDE session while you try
+different queries. Because this module is imported (rather than run), its
+caches survive re-running a script, so the title table and HDF5 files are
+only opened once per session, and recently used query vectors stay in memory.
+"""
+
+import functools
+import h5py
+import numpy as np
+from title_table import TitleTable
+
+
+@functools.lru_cache(maxsize=None)
+def load_titles(path):
+    """
+    Open the article title table (built by 'convert_titles.py') at 'path'.
+    """
+    return TitleTable(path)
+
+
+@functools.lru_cache(maxsize=None)
+def open_h5(path):
+    """
+    Open the HDF5 file at 'path' for reading.
+    """
+    return h5py.File(path, 'r')
+
+
+def _block_rows(path, dataset_name):
+    """
+    Number of rows in each block of the dataset which 'read_block' reads.
+
+    HDF5 reads (and decompresses) a chunked dataset a whole chunk at a time,
+    so a block is one chunk of rows. A contiguous dataset is just read one
+    row at a time.
+    """
+    ds = open_h5(path)[dataset_name]
+    return ds.chunks[0] if ds.chunks else 1
+
+
+@functools.lru_cache(maxsize=64)
+def read_block(path, dataset_name, block_idx):
+    """
+    Read (and cache) block 'block_idx' of the dataset's rows as float32.
+    """
+    ds = open_h5(path)[dataset_name]
+    block_rows = _block_rows(path, dataset_name)
+    block = ds[block_idx * block_rows:(block_idx + 1) * block_rows]
+    return block.astype('float32', copy=False)
+
+
+def read_vectors(path, dataset_name, idxs):
+    """
+    Gather the dataset rows 'idxs' into a float32 matrix, one per row.
+
+    Rows are read through the 'read_block' cache, so rows in recently used
+    chunks aren't read from disk again.
+
+    :type path: string
+    :param path: Path to the HDF5 file.
+
+    :type dataset_name: string
+    :param dataset_name: Name of the dataset within the file.
+
+    :type idxs: list
+    :param idxs: Indeces of the rows to read.
+
+    :rtype: numpy.ndarray
+    :return: Matrix of the requested rows, in the order given.
+    """
+    block_rows = _block_rows(path, dataset_name)
+
+    # Read the blocks holding the rows in file order, so that any blocks
+    # which aren't cached yet are read sequentially.
+    blocks = {b: read_block(path, dataset_name, b)
+              for b in sorted(set(i // block_rows for i in idxs))}
+
+    return np.stack([blocks[i // block_rows][i % block_rows] for i in idxs])
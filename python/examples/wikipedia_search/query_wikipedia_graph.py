@@ -17,9 +17,10 @@ title is capitalized, unless the title is someone's name, etc. Refer to
 wikipedia online to get the correct title.
 """
 
-import h5py
-import pickle
+import numpy as np
+import sys
 import time
+from local_data import load_titles, open_h5
 
 # ==============================
 #     Parameters
@@ -37,46 +38,60 @@ query_article = "Water treatment"
 
 # Filepath parameters 
 path_on_local_drive = "./wiki_data/lsi_10NN_graph.h5"
-path_to_titles = "./wiki_data/titles_to_id.pickle"
+path_to_title_table = "./wiki_data/titles"
 
 # ==============================
 #       Load the dataset
 # ==============================    
-local_loaded = False
-if not local_loaded:    
-    print('Loading article titles...')
-    
-    # Load article titles
-    title_to_idx = pickle.load( open( path_to_titles, "rb" ) )
-    id_to_title = dict(zip(title_to_idx.values(), title_to_idx.keys()))
-    
-    # Open the local copy of the dataset file.
-    h5f = h5py.File(path_on_local_drive, 'r')
+# These loaders cache what they open, so re-running this script in the same
+# session doesn't load anything again.
+print('Loading article titles...')
+
+# Memory-map the article title table (built by 'convert_titles.py').
+titles = load_titles(path_to_title_table)
+
+# Open the local copy of the dataset file.
+h5f = open_h5(path_on_local_drive)
+
+# Look up the dataset handles once, rather than on every lookup.
+idxs_ds = h5f['idxs']
+dists_ds = h5f['dists']
+
+# Preallocate the buffers that the query's row of results is read into.
+idxs = np.empty(idxs_ds.shape[1], dtype=idxs_ds.dtype)
+dists = np.empty(dists_ds.shape[1], dtype=dists_ds.dtype)
 
 # ==================================
 #       Look up the results
 # ==================================
 print('\nFinding most similar articles to "%s"...\n' % query_article)
     
-# Verify the specified article title is valid.
-if not query_article in title_to_idx:        
-    raise('Article title "%s" does not match any in the dataset.' % query_article)
-
 t0 = time.time()
 
-# Look up the index of the vector for this article.
-query_idx = title_to_idx[query_article]
+# Look up the index of the vector for this article, and verify the specified
+# article title is valid.
+query_idx = titles.get(query_article)
+if query_idx is None:
+    raise ValueError('Article title "%s" does not match any in the dataset.' % query_article)
+
+# Look up the nearest neighbors, reading them directly into the buffers.
+idxs_ds.read_direct(idxs, np.s_[query_idx, :])
+dists_ds.read_direct(dists, np.s_[query_idx, :])
 
-# Look up the nearest neighbors.
-idxs = h5f['idxs'][query_idx, :]
-dists = h5f['dists'][query_idx, :] 
+# 'wikipedia_knn_graph.py' marks the graph files it writes with the 
+# 'self_match_dropped' attribute. Files written without the marker by older
+# versions may still start with the query article itself, so skip the first
+# neighbor if it is the query article.
+if not h5f.attrs.get('self_match_dropped', False) and idxs[0] == query_idx:
+    idxs = idxs[1:]
+    dists = dists[1:]
 
 # Print the article titles of the ten nearest neighbors.
-# For each of the k results (omitting the top match, which
-# is the query article itself)...
-print('    %50s    Distance' % 'Title')
-print('    %50s    ========' % '=====')
-for i in range(1, len(idxs)):
-    print('    %50s    %.3f' % ((id_to_title[idxs[i]]), dists[i]))
+# Format one line for each of the results (the graph doesn't include the 
+# query article itself), and write them all out at once.
+lines = ['    %50s    Distance' % 'Title', '    %50s    ========' % '=====']
+lines += ['    %50s    %.3f' % (titles.title(i), d) 
+          for i, d in zip(idxs, dists)]
+sys.stdout.write('\n'.join(lines) + '\n')
 
 print('\nknn graph lookup took %.0f ms.' % ((time.time() - t0) * 1000.0))
\ No newline at end of file
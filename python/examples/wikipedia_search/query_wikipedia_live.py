@@ -22,22 +22,23 @@ each word of a multiword title is capitalizaed. Refer to wikipedia article title
 """
 
 from gpuclient import GpuClient
-import h5py
-import pickle
+from local_data import load_titles, read_vectors
+import sys
 
 # ==============================
 #     Parameters
 # ==============================
 
-# Specify the title of the Wikipedia article to use as the search query.
+# Specify the titles of the Wikipedia articles to use as the search queries.
+# All of the articles are searched for together in a single query.
 #
 # Multi-word titles can specified with spaces, such as "Abraham Lincoln".
 # Capitalization should match the Wikipedia article title exactly. See the
 # examples below.
 
-#query_article = "Abraham Lincoln"
-#query_article = "Computer science"
-query_article = "Water treatment"
+#query_articles = ["Abraham Lincoln"]
+#query_articles = ["Computer science", "Abraham Lincoln"]
+query_articles = ["Water treatment"]
 
 # Connection parameters
 api_key = ""
@@ -47,7 +48,7 @@ nearist_ip = ""
 # Filepath parameters 
 path_on_nearist_server = "/nearist/Wikipedia/lsi_index_float32.h5"
 path_on_local_drive = "./wiki_data/lsi_index_float32.h5"
-path_to_titles = "./wiki_data/titles_to_id.pickle"
+path_to_title_table = "./wiki_data/titles"
 
 # ==============================
 #     Establish connection
@@ -66,68 +67,69 @@ with c.open(nearist_ip, nearist_port, api_key):
     # ==============================
     #       Load the dataset
     # ==============================
-    # Set the '*_loaded' flags to 'True' after the first run of this script so 
-    # that you don't have to load anything again.
-    remote_loaded = False
-    if not remote_loaded:
-        print('Loading dataset vectors from remote server into GPU...')
-    
-        # Load dataset into GPU memory.
-        c.load_dataset_file(
-            file_name = path_on_nearist_server, # Remote file path
-            dataset_name = 'lsi'  # Dataset name within HDF5 file
-        )
-        
-    local_loaded = False
-    if not local_loaded:    
-        print('Loading article titles...')
-        
-        # Load dictionary mapping article titles to their vector index.
-        title_to_idx = pickle.load( open( path_to_titles, "rb" ) )
-        
-        # Also create a map from index to title (for displaying the
-        # search results).
-        id_to_title = dict(zip(title_to_idx.values(), title_to_idx.keys()))
+    # Nothing is loaded twice when this script is re-run in the same session:
+    # the client skips loading a dataset which is already in GPU memory, and
+    # the local loaders cache what they open.
+    print('Loading dataset vectors from remote server into GPU...')
+
+    # Load dataset into GPU memory.
+    c.load_dataset_file(
+        file_name = path_on_nearist_server, # Remote file path
+        dataset_name = 'lsi'  # Dataset name within HDF5 file
+    )
         
-        # Open the *local* copy of the dataset file.
-        h5f = h5py.File(path_on_local_drive, 'r')
+    print('Loading article titles...')
+    
+    # Memory-map the table mapping article titles to their vector index
+    # and back (built by 'convert_titles.py').
+    titles = load_titles(path_to_title_table)
     
     # ==================================
-    #       Load the query vector
+    #       Load the query vectors
     # ==================================
-    print('Retrieving local query vector...')
-        
-    # Verify the specified article title is valid.
-    if not query_article in title_to_idx:        
-        c.close()
-        raise('Article title "%s" does not match any in the \
-              dataset.' % query_article)
+    print('Retrieving local query vectors...')
     
-    # Look up the index of the vector for this article.
-    query_idx = title_to_idx[query_article]
+    query_idxs = []
+    for query_article in query_articles:
+        # Look up the index of the vector for this article, and verify the
+        # specified article title is valid. (The 'with' block closes the 
+        # connection if we raise here.)
+        query_idx = titles.get(query_article)
+        if query_idx is None:
+            raise ValueError('Article title "%s" does not match any in the '
+                             'dataset.' % query_article)
+        
+        query_idxs.append(query_idx)
     
-    # Read in the query vector.
-    query_vec = h5f['lsi'][query_idx].astype('float32')
+    # Gather the query vectors from the *local* copy of the dataset into a
+    # matrix, one per row. Recently used chunks of the file are cached, so
+    # re-querying nearby articles doesn't read from disk again.
+    query_vecs = read_vectors(path_on_local_drive, 'lsi', query_idxs)
     
     # =======================================
     #       Search for similar articles
     # =======================================
-    print('\nFinding most similar articles to "%s"...\n' % query_article)
+    print('\nFinding most similar articles to %s...\n' % 
+          ', '.join('"%s"' % t for t in query_articles))
     
     # Set k = 11 to get 10 results since the top result will always be the 
     # query article itself.
     k = 11
     
-    # Submit the query to the Nearist GPU server.    
-    dists, idxs = c.query(query_vec, k=k)
+    # Submit all of the queries to the Nearist GPU server at once.
+    dists, idxs = c.query(query_vecs, k=k)
     
-    # Print the article titles of the ten nearest neighbors.
-    # For each of the k results (omitting the top match, which
-    # is the query article itself)...
-    print('    %50s    Distance' % 'Title')
-    print('    %50s    ========' % '=====')
-    for i in range(1, k):
-        print('    %50s    %.3f' % ((id_to_title[idxs[0, i]]), dists[0, i]))
+    # Print the article titles of the ten nearest neighbors for each query.
+    # Format one line for each of the k results (omitting the top match, 
+    # which is the query article itself), and write them all out at once.
+    lines = []
+    for row, query_article in enumerate(query_articles):
+        if len(query_articles) > 1:
+            lines += ['', '  "%s"' % query_article]
+        lines += ['    %50s    Distance' % 'Title', '    %50s    ========' % '=====']
+        lines += ['    %50s    %.3f' % (titles.title(i), d) 
+                  for i, d in zip(idxs[row, 1:k], dists[row, 1:k])]
+    sys.stdout.write('\n'.join(lines) + '\n')
     
     # Print out the timing measurements for the query operation.
     c.print_timings()
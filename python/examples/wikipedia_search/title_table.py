@@ -0,0 +1,150 @@
+"""
+Purpose:
+
+A compact, memory-mapped lookup table between Wikipedia article titles and
+their vector indeces, used in place of the 'titles_to_id.pickle' dictionary.
+
+Loading the pickle creates a Python dictionary with ~4.2M entries (and the
+examples then built a second, inverted copy of it), which takes several
+seconds and over a gigabyte of memory. The table instead stores all of the
+titles once, as UTF-8 bytes, in a single file, along with a few numpy index
+arrays. All of these are memory-mapped, so only the pages touched by a
+lookup are ever read from disk.
+
+The table is a directory containing:
+    titles_blob.bin   - All titles (UTF-8), concatenated in sorted order.
+    title_offsets.npy - int64 start offset of each title in the blob, plus
+                        a final entry with the total length of the blob.
+    title_ids.npy     - int32 vector index of each (sorted) title.
+    id_to_rank.npy    - int32 position of each vector's title in the sorted
+                        order, or -1 if the vector has no title.
+
+Use 'convert_titles.py' to build the table from 'titles_to_id.pickle'.
+"""
+
+import os
+import numpy as np
+
+
+class TitleTable:
+    """
+    Maps article titles to vector indeces (by binary search over the sorted
+    titles), and vector indeces back to titles.
+    """
+
+    def __init__(self, path):
+        """
+        Memory-map the table stored in the directory 'path'.
+
+        :type path: string
+        :param path: Directory written by 'TitleTable.build'.
+        """
+        self.blob = np.memmap(os.path.join(path, 'titles_blob.bin'),
+                              dtype=np.uint8, mode='r')
+        self.offsets = np.load(os.path.join(path, 'title_offsets.npy'),
+                               mmap_mode='r')
+        self.ids = np.load(os.path.join(path, 'title_ids.npy'), mmap_mode='r')
+        self.id_to_rank = np.load(os.path.join(path, 'id_to_rank.npy'),
+                                  mmap_mode='r')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, title):
+        return self.get(title) is not None
+
+    def __getitem__(self, title):
+        idx = self.get(title)
+        if idx is None:
+            raise KeyError(title)
+        return idx
+
+    def _title_bytes(self, rank):
+        """
+        Return the UTF-8 bytes of the title at position 'rank' in the sorted
+        order.
+        """
+        return self.blob[self.offsets[rank]:self.offsets[rank + 1]].tobytes()
+
+    def get(self, title, default=None):
+        """
+        Look up the vector index for an article title.
+
+        :type title: string
+        :param title: The article title, with the exact capitalization used
+                      by Wikipedia.
+
+        :rtype: int
+        :return: The vector index, or 'default' if the title isn't found.
+        """
+        key = title.encode('utf-8')
+
+        # Binary search for the first title which is >= 'key'.
+        lo = 0
+        hi = len(self.ids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._title_bytes(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        # Check whether we landed on an exact match.
+        if lo < len(self.ids) and self._title_bytes(lo) == key:
+            return int(self.ids[lo])
+
+        return default
+
+    def title(self, idx):
+        """
+        Look up the article title for a vector index.
+
+        :type idx: int
+        :param idx: Index of the article's vector in the dataset.
+
+        :rtype: string
+        :return: The article title.
+        """
+        rank = self.id_to_rank[idx]
+        if rank < 0:
+            raise KeyError(idx)
+        return self._title_bytes(rank).decode('utf-8')
+
+    @staticmethod
+    def build(title_to_idx, path):
+        """
+        Write the table for the dictionary 'title_to_idx' to the directory
+        'path' (which is created if needed).
+
+        :type title_to_idx: dict
+        :param title_to_idx: Dictionary mapping article titles to vector
+                             indeces.
+
+        :type path: string
+        :param path: Output directory.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        # Sort the titles by their UTF-8 bytes, which is the order 'get'
+        # searches in.
+        items = sorted((t.encode('utf-8'), i) for t, i in title_to_idx.items())
+
+        # The start of each title in the blob is the running sum of the
+        # lengths of the titles before it.
+        offsets = np.zeros(len(items) + 1, dtype=np.int64)
+        np.cumsum([len(t) for t, i in items], out=offsets[1:])
+
+        ids = np.array([i for t, i in items], dtype=np.int32)
+
+        # Invert the sorted order, so that titles can be found by vector index.
+        id_to_rank = np.full(int(ids.max()) + 1, -1, dtype=np.int32)
+        id_to_rank[ids] = np.arange(len(ids), dtype=np.int32)
+
+        with open(os.path.join(path, 'titles_blob.bin'), 'wb') as f:
+            for t, i in items:
+                f.write(t)
+
+        np.save(os.path.join(path, 'title_offsets.npy'), offsets)
+        np.save(os.path.join(path, 'title_ids.npy'), ids)
+        np.save(os.path.join(path, 'id_to_rank.npy'), id_to_rank)
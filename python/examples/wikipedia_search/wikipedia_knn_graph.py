@@ -1,7 +1,7 @@
 from __future__ import division
 import h5py
 import sys
-import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from gpuclient import GpuClient
 
 # ==============================
@@ -46,18 +46,16 @@ with c.open(nearist_ip, nearist_port, api_key):
     # ==============================
     #       Load the dataset
     # ==============================
-    # Set the 'loaded' flag to 'True' after the first run of this script so 
-    # that you don't have to load anything again.
-    loaded = True
-    if not loaded:
-        print('Loading dataset vectors from remote server into GPU...')
-    
-        # Load dataset into GPU memory.
-        c.load_dataset_file(
-            file_name = path_on_nearist_server,  # Remote file path
-            dataset_name = dataset_name,  # Dataset name within HDF5 file
-            metric = 'L2'
-        )
+    # The client skips this if the dataset is already loaded (e.g., when the
+    # script is re-run in the same session).
+    print('Loading dataset vectors from remote server into GPU...')
+
+    # Load dataset into GPU memory.
+    c.load_dataset_file(
+        file_name = path_on_nearist_server,  # Remote file path
+        dataset_name = dataset_name,  # Dataset name within HDF5 file
+        metric = 'L2'
+    )
     
     # ==============================
     #      Measure Throughput
@@ -66,22 +64,40 @@ with c.open(nearist_ip, nearist_port, api_key):
     print('Performing a test query to estimate throughput...')
     
     # Use a handful of batches to estimate throughput.
-    test_batch_size = 4 * batch_size
+    num_test_batches = 4
+    test_batch_size = num_test_batches * batch_size
     
     # Open the local copy of the dataset file.
     h5f = h5py.File(path_on_local_drive, 'r')
     
-    # Read the first four batches of the Wikipedia vectors into local 
-    # memory.
-    vectors = h5f[dataset_name][0:test_batch_size, :]
+    def read_batch(i):
+        # Read batch 'i' of the Wikipedia vectors into local memory, having 
+        # h5py convert them to float32 as they're read.
+        return h5f[dataset_name].astype('float32')[i * batch_size:(i + 1) * batch_size, :]
     
-    # Perform a query on the first four batches.
-    dists, idxs = c.query(vectors, k=k, batch_size=batch_size)
+    # Perform a query on each of the first four batches. A background thread
+    # reads the next batch from disk while the current one is being queried
+    # (the socket calls release the GIL while waiting on the server).
+    server_elapsed = 0
+    with ThreadPoolExecutor(max_workers=1) as reader:
+        next_batch = reader.submit(read_batch, 0)
+        
+        for i in range(num_test_batches):
+            vectors = next_batch.result()
+            
+            # Start reading the following batch.
+            if i + 1 < num_test_batches:
+                next_batch = reader.submit(read_batch, i + 1)
+            
+            dists, idxs = c.query(vectors, k=k, batch_size=batch_size)
+            
+            # Accumulate the time spent on the server.
+            server_elapsed += c.server_elapsed
         
     # Measure the GPU throughput (queries per second) based on this test.
     # We don't need to include internet overhead in this measurement because
     # the query vectors for the knn table are already on the remote server.
-    throughput = test_batch_size / c.server_elapsed
+    throughput = test_batch_size / server_elapsed
     
     # Estimate the time to complete the whole graph in minutes
     est_graph_time = h5f[dataset_name].shape[0] / throughput / 60.0
@@ -94,8 +110,10 @@ with c.open(nearist_ip, nearist_port, api_key):
     # ==============================
     #      Compute 10-NN graph
     # ==============================
+    num_vecs = h5f[dataset_name].shape[0]
+    
     print('Running knn-table for %d vectors, batch_size %d, with k=%d...' % 
-          (h5f[dataset_name].shape[0], batch_size, k))
+          (num_vecs, batch_size, k))
     sys.stdout.flush()
     
     # Specify the dataset file on the Nearist GPU server to read the query 
@@ -120,16 +138,30 @@ with c.open(nearist_ip, nearist_port, api_key):
 #      Store the results
 # ==============================
 
-# Delete column 0 from the results                                
-np.delete(dists, 0, axis=1)
-np.delete(idxs, 0, axis=1)
-
 print('Writing results to local disk...')
 
-# Write out the two matrices to an HDF5 file.
-h5f = h5py.File(output_on_local_drive, 'w')
-h5f.create_dataset(name='dists', data=dists)
-h5f.create_dataset(name='idxs', data=idxs)
-h5f.close()
+# The output file is only created now that the results have arrived, so a 
+# failed run doesn't overwrite the graph from a previous run.
+# The result datasets are chunked by 'batch_size' rows, and each batch of 
+# results is written out as one contiguous chunk. The first neighbor of each
+# vector is the vector itself, which isn't stored, so the graph has k - 1 
+# columns.
+with h5py.File(output_on_local_drive, 'w') as out_h5f:
+    out_dists = out_h5f.create_dataset(name='dists', shape=(num_vecs, k - 1), 
+                                       dtype='float32', chunks=(batch_size, k - 1))
+    out_idxs = out_h5f.create_dataset(name='idxs', shape=(num_vecs, k - 1), 
+                                      dtype='int32', chunks=(batch_size, k - 1))
+    
+    # Record that the self-match column was dropped, so that readers such as
+    # 'query_wikipedia_graph.py' don't need to guess from the column count.
+    out_h5f.attrs['self_match_dropped'] = True
+    
+    # Write out the two matrices one chunk at a time, dropping column 0 (the
+    # query vector itself) from the results. Slicing the column off is just
+    # a view, so nothing is copied before the write.
+    for start in range(0, num_vecs, batch_size):
+        end = min(start + batch_size, num_vecs)
+        out_dists[start:end] = dists[start:end, 1:]
+        out_idxs[start:end] = idxs[start:end, 1:]
     
 print('Done')
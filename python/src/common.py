@@ -1,10 +1,74 @@
+import socket
 import struct
 import binascii
 import json
-import pickle
+import zlib
 import numpy as np
 from enum import IntEnum
 
+# Use the fastest available CRC-32 implementation for packet bodies. The 
+# zlib-ng and ISA-L bindings fold many bytes per instruction with carry-less
+# multiplication (PCLMULQDQ/VPCLMULQDQ on x86) and are much faster than a 
+# table-driven CRC on large buffers. All of these compute the same CRC-32 as 
+# 'binascii.crc32', so the checksums on the wire are unchanged.
+try:
+    from zlib_ng import zlib_ng as _crc32_module
+except ImportError:
+    try:
+        from isal import isal_zlib as _crc32_module
+    except ImportError:
+        _crc32_module = zlib
+_crc32_fast = _crc32_module.crc32
+
+# Precompiled formats for the fixed-layout parts of the packets, so that the
+# format strings aren't looked up and parsed on every call.
+#   'L' is unsigned long (32-bit, 4 bytes)
+#   'Q' is unsigned long long (64-bit, 8 bytes)
+#   'f' is float (32-bit, 4 bytes)
+#   '8s' is an 8 byte string
+_REQUEST_FIELDS = struct.Struct("=LL8sQ")      # Request header, minus checksum
+_REQUEST_HEADER = struct.Struct("=LL8sQL")     # Request header
+_RESPONSE_FIELDS = struct.Struct("=LLLfQ")     # Response header, minus checksum
+_RESPONSE_HEADER = struct.Struct("=LLLfQL")    # Response header
+_U32 = struct.Struct("=L")                     # Checksums
+_SHAPE = struct.Struct("=LL")                  # Result matrix shape
+
+# Flag asking 'recv_into' to wait for the full amount requested, where the 
+# platform supports it.
+_MSG_WAITALL = getattr(socket, 'MSG_WAITALL', 0)
+
+# Use orjson for the JSON payloads if it's installed--it's a C extension which
+# serializes directly to bytes, and is several times faster than the json 
+# module. Both produce standard JSON, so either end of the connection can 
+# parse the other's payloads.
+try:
+    import orjson
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except ImportError:
+    # In Python 3, it's required that we explicitly convert the string to 
+    # bytes with 'encode'.
+    _json_dumps = lambda obj: json.dumps(obj).encode()
+    _json_loads = json.loads
+
+# MessagePack is accepted as an alternative encoding for the control payloads
+# if the msgpack module is installed. It's a binary format which is smaller 
+# and quicker to parse than JSON. A JSON payload always begins with '{', 
+# which can't begin a MessagePack map, so the receiver can tell the two apart
+# without any change to the packet header.
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# Flag bit set in the command field of a packet whose vectors (for a request)
+# or distances (for a response) are sent as float16 rather than float32, 
+# halving their size on the wire. 'unpack_header' clears the flag from the
+# command and records it in the packet's 'float16' property. Only send 
+# float16 packets to a receiver which understands the flag.
+_FLOAT16 = 0x100
+
 
 class Command(IntEnum):
     """
@@ -36,32 +100,128 @@ class Status(IntEnum):
     
     UNKNOWN_ERROR = 0xFF
 
+class ChecksumError(IOError):
+    """
+    Raised when a packet body doesn't match its checksum.
+    
+    The whole packet has still been received, so if it was the response to
+    the only request in flight, the connection is still in step with the 
+    server and the request can be sent again ('GpuClient' does this once). 
+    Where other requests are in flight (a pipelined query, or 
+    'GpuAsyncClient'), the connection is closed, as for other errors.
+    """
+    pass
+
 class Common:
+    @staticmethod
+    def crc32(buf, value=0):
+        """
+        Helper function to compute the CRC-32 checksum of 'buf' as an 
+        unsigned 32-bit integer.
+        
+        Buffers of 256 bytes or more (i.e., packet bodies) use the fastest
+        available CRC implementation, reading them through a memoryview so
+        they aren't copied. Short buffers (the packet headers) aren't worth
+        the setup cost of the vectorized code, so they use 'binascii'.
+        
+        Passing the checksum of the preceding data as 'value' continues that
+        checksum, so a buffer can be checksummed a piece at a time.
+        """
+        if len(buf) < 256:
+            return binascii.crc32(buf, value) & 0xFFFFFFFF
+        
+        return _crc32_fast(memoryview(buf), value) & 0xFFFFFFFF
+
     @staticmethod
     def receive_all(conn, length):
         """
         Helper function to receive 'length' bytes or return None if EOF is hit.
         """
 
-        data = bytearray()
+        # Allocate the full buffer up front and have the socket write directly
+        # into it, rather than growing a bytearray with each received packet.
+        data = bytearray(length)
+        view = memoryview(data)
+        received = 0
     
         # Loop until we've received 'length' bytes.        
-        while len(data) < length:
+        while received < length:
     
-            # Receive the remaining bytes. The amount of data returned might
-            # be less than 'length'.
-            packet = conn.recv(length - len(data))
+            # Receive the remaining bytes into the unfilled part of the 
+            # buffer. MSG_WAITALL asks the kernel to wait until all of them
+            # have arrived, so this normally takes a single call, but the 
+            # amount of data returned might still be less than 'length' 
+            # (e.g., if the call is interrupted by a signal).
+            num_bytes = conn.recv_into(view[received:], length - received, 
+                                       _MSG_WAITALL)
     
             # If we received 0 bytes, the connection has been closed...            
-            if not packet:
+            if not num_bytes:
                 return None
     
-            # Append the received bytes to 'data'.    
-            data += packet
+            # Advance past the received bytes.
+            received += num_bytes
     
         # Return the 'length' bytes of received data.
         return data
 
+    @staticmethod
+    def receive_body(conn, length, data=None):
+        """
+        Helper function to receive a packet body of 'length' bytes, and the 
+        checksum which follows it, or return None if EOF is hit.
+        
+        If 'data' is given (it must be at least 'length' + 4 bytes), the 
+        packet is received into it so that a buffer can be reused between 
+        calls, and a memoryview of the body within 'data' is returned.
+        
+        The body and its checksum are received together into one buffer, 
+        so a short checksum doesn't need a receive call of its own. The 
+        body's checksum is computed a chunk at a time as the chunks arrive,
+        while the rest of the body is still in flight, rather than in a 
+        second pass over the whole body once it has been received.
+        
+        Raises a ChecksumError if the body doesn't match its checksum.
+        """
+
+        # Receive the body and checksum into a preallocated buffer, as in 
+        # 'receive_all'.
+        total = length + _U32.size
+        reuse = data is not None
+        if not reuse:
+            data = bytearray(total)
+        view = memoryview(data)
+        received = 0
+        crc = 0
+    
+        while received < total:
+            num_bytes = conn.recv_into(view[received:], total - received)
+    
+            # If we received 0 bytes, the connection has been closed...            
+            if not num_bytes:
+                return None
+    
+            # Add the part of the received chunk which belongs to the body
+            # to the running checksum.
+            if received < length:
+                crc = Common.crc32(view[received:min(received + num_bytes, length)], crc)
+            received += num_bytes
+    
+        # Compare the received checksum to the one we computed.
+        if not _U32.unpack_from(data, length)[0] == crc:
+            raise ChecksumError("Packet payload does not match checksum!")
+    
+        # The caller's buffer may be larger than this packet, so just return 
+        # a view of the body within it.
+        if reuse:
+            return view[0:length]
+        
+        # Trim the checksum off of the end of the buffer, leaving the body.
+        view.release()
+        del data[length:]
+    
+        return data
+
 
 class Request:
     """
@@ -88,38 +248,97 @@ class Request:
         self.command = command
         self.k = k
         
+        # The API key is kept as the 8 bytes sent in the header. Python 3 
+        # requires that we explicitly convert a string key to bytes with 
+        # 'encode'; a key which is already bytes is used as-is.
+        if isinstance(api_key, str):
+            api_key = api_key.encode()
+        
         # Pad the API key out to 8 characters, and only take 8 characters.
-        self.api_key = api_key.ljust(8)[0:8]
+        self._api_key_bytes = api_key.ljust(8, b' ')[0:8]
         
         self.body_length = body_length
         self.body = body
         
+        # Whether the vectors in the body are float16 rather than float32.
+        self.float16 = False
+        
+        # Buffer which 'iov' packs the header into. It's allocated on first
+        # use and then reused, so a request which is re-sent with a new 
+        # payload (e.g., each mini-batch of a query) doesn't allocate a new 
+        # header every time.
+        self._header_buf = None
+        
         # Store the header size to be referenced elsewhere in the code.
-        self.header_size = 28
+        self.header_size = _REQUEST_HEADER.size
 
+    @property
+    def api_key(self):
+        """
+        The 8 character API key, as a string.
+        """
+        # Python 3 requires the call to 'decode' to convert the API key from 
+        # bytes to string.
+        return self._api_key_bytes.decode()
+    
     def pack_json(self, obj):
         """
         Formats the JSON object into a string to be included in the packet.
         """
-        # Use the json module to construct a string representation and add it
-        # to the request. In Python 3, it's required that we explicitly 
-        # convert the string to bytes with 'encode'.
-        self.body = json.dumps(obj).encode()
+        # Construct the JSON representation as bytes and add it to the 
+        # request.
+        self.body = _json_dumps(obj)
+        self.body_length = len(self.body)
+    
+    def pack_msgpack(self, obj):
+        """
+        Formats the object as MessagePack to be included in the packet.
+        
+        This is an alternative to 'pack_json' which 'unpack_json' also 
+        accepts. Only use it when the receiver is known to have msgpack
+        installed.
+        """
+        if msgpack is None:
+            raise ImportError("The msgpack module is not installed.")
+        
+        self.body = msgpack.packb(obj, use_bin_type=True)
         self.body_length = len(self.body)
     
     def unpack_json(self):
         """
         Parses json string into an object.
+        
+        Payloads packed with 'pack_msgpack' are recognized and parsed as well.
         """
-        return json.loads(self.body)
+        # A MessagePack map starts with a fixmap (0x80-0x8f), map 16 (0xde) 
+        # or map 32 (0xdf) byte, none of which can start JSON text. Anything
+        # else is parsed as JSON, so malformed JSON still reports a JSON 
+        # error.
+        if msgpack is not None and len(self.body) > 0 and \
+           (0x80 <= self.body[0] <= 0x8f or self.body[0] in (0xde, 0xdf)):
+            return msgpack.unpackb(self.body, raw=False)
+        
+        return _json_loads(self.body)
     
-    def pack_vectors(self, vectors):
+    def pack_vectors(self, vectors, float16=False):
         """
-        Converts the matrix of vectors into bytes as a packet payload.
+        Sets the matrix of vectors as the packet payload.
+        
+        The payload is a byte view of the vectors' memory rather than a copy,
+        so the vectors must not be modified until the request has been sent.
+        
+        :type float16: bool
+        :param float16: Send the vectors as float16, which halves the size of
+                        the payload. The vectors are converted to float16 
+                        here, and back to float32 by 'unpack_vectors'.
         """
-        # Numpy ndarray has a function specifically for conversion to a byte 
-        # string.
-        self.body = vectors.tobytes()
+        self.float16 = float16
+        if float16:
+            vectors = vectors.astype(np.float16)
+        
+        # Make sure the vectors are laid out contiguously (this is a no-op if
+        # they already are), then view their memory as raw bytes.
+        self.body = memoryview(np.ascontiguousarray(vectors)).cast('B')
         
         # Store the length in bytes of the body.
         self.body_length = len(self.body)
@@ -135,17 +354,26 @@ class Request:
         :param dim: Length of vectors (number of components, not bytes).
         
         :rtype: numpy.ndarray
-        :return: Matrix of vectors, one per row.
+        :return: Matrix of float32 vectors, one per row.
         """
         # Numpy implements a function for converting from bytes to ndarray.
-        vectors = np.frombuffer(self.body, dtype='float32')
-                
-        # Infer the number of vectors in the payload based on the vector 
-        # length.
-        num_vecs = int(len(vectors) / dim)
-        
-        # Reshape the array into a matrix of vectors.
-        return vectors.reshape((num_vecs, dim))   
+        # Going through a memoryview ensures the array is a view of the 
+        # received body rather than a copy of it.
+        if self.float16:
+            vectors = np.frombuffer(memoryview(self.body), dtype='float16')
+        else:
+            vectors = np.frombuffer(memoryview(self.body), dtype='float32')
+        
+        # Reshape the array into a matrix of vectors, letting numpy infer the
+        # number of vectors from the vector length. This raises a ValueError
+        # if the payload isn't a whole number of vectors.
+        vectors = vectors.reshape((-1, dim))
+        
+        # Vectors sent as float16 are converted back to float32.
+        if self.float16:
+            vectors = vectors.astype(np.float32)
+        
+        return vectors
     
     def pack(self):
         """
@@ -167,32 +395,57 @@ class Request:
         :return: Completed packet encoded in bytes.
         """
         
-        # Pack the message header.        
-        #   'L' is unsigned long (32-bit, 4 bytes)
-        buf = struct.pack("=LL", self.command, self.k)
+        # Join the pieces of the packet into a single buffer.
+        return b''.join(self.iov())
 
-        # Add the API key to the header (it's 8 characters, 8 bytes).
-        # Python 3 requires that we explicitly convert the string to bytes with
-        # 'encode'.
-        buf += self.api_key.encode()
+    def iov(self):
+        """
+        Returns the binary representation of this request as a list of 
+        buffers (header, body, body checksum) which together make up the 
+        packet returned by 'pack'.
         
-        # 'Q' is unsigned long long (64-bit, 8 bytes)
-        buf += struct.pack("=Q", self.body_length)
+        The body is not copied, so the buffers can be sent with a single
+        scatter/gather write (socket.sendmsg) without first concatenating 
+        them.
+        
+        The header buffer is reused by the next call to 'iov', so the 
+        buffers should be sent before the request is packed again.
+        
+        :rtype: list
+        :return: The packet buffers, in order.
+        """
+        
+        # Pack the message header fields in a single call.
+        #   'L' is unsigned long (32-bit, 4 bytes)
+        #   '8s' is the 8 character API key (8 bytes), encoded in __init__.
+        #   'Q' is unsigned long long (64-bit, 8 bytes)
+        # The fields and their checksum are written into a single header 
+        # buffer, rather than packing each and concatenating them.
+        if self._header_buf is None:
+            self._header_buf = bytearray(_REQUEST_HEADER.size)
+        buf = self._header_buf
+        command = (self.command | _FLOAT16) if self.float16 else self.command
+        _REQUEST_FIELDS.pack_into(buf, 0, command, self.k, 
+                                  self._api_key_bytes, self.body_length)
         
         # Add a checksum of the header fields.
-        buf += struct.pack("=L", binascii.crc32(buf) & 0xFFFFFFFF)
+        fields = memoryview(buf)[0:_REQUEST_FIELDS.size]
+        _U32.pack_into(buf, _REQUEST_FIELDS.size, 
+                       binascii.crc32(fields) & 0xFFFFFFFF)
+
+        buffers = [buf]
 
         # If this request includes a body...
         if self.body_length > 0 and self.body is not None:
             
-            # Add the payload to the buffer.
-            buf += self.body
+            # Add the payload.
+            buffers.append(self.body)
             
             # Append a checksum to the end of the body.
-            buf += struct.pack("=L", binascii.crc32(self.body) & 0xFFFFFFFF)
+            buffers.append(_U32.pack(Common.crc32(self.body)))
 
-        # Return the completed packet buffer.
-        return buf
+        # Return the packet buffers.
+        return buffers
 
     def unpack_header(self, buffer):
         """
@@ -209,38 +462,40 @@ class Request:
         :param buffer: The byte array containing the header.
         """
         
-        # Unpack the command and query k.
-        (self.command, self.k) = struct.unpack_from("=LL", buffer)
-            
-        # Upnack the 8 character API key, starting at offset 8.
-        # This returns a tuple with one element, so de-reference the tuple.
-        # Python 3 requires the call to 'decode' to convert from bytes to 
-        # string.
-        self.api_key = struct.unpack_from("=8s", buffer, 8)[0].decode()
+        # Unpack the command, query k, 8 character API key, body length, and
+        # checksum.
+        (self.command, self.k, api_key, self.body_length, self.checksum) = \
+            _REQUEST_HEADER.unpack_from(buffer)
         
-        # Unpack the body length and checksum.
-        (self.body_length, self.checksum) = struct.unpack_from("=QL", buffer, 16)
+        # Separate the float16 flag from the command.
+        self.float16 = bool(self.command & _FLOAT16)
+        self.command &= ~_FLOAT16
+            
+        # Keep the API key as bytes. It's only decoded to a string if the 
+        # 'api_key' property is read.
+        self._api_key_bytes = api_key
         
         # Validate the header checksum--compare the transmitted checksum to a
         # checksum of the header (minus the last four bytes of the header, 
-        # which are the transmitted checksum!)
-        if not self.checksum == (binascii.crc32(buffer[0:-4]) & 0xFFFFFFFF):
+        # which are the transmitted checksum!) The header is read through a
+        # memoryview so that it isn't copied.
+        if not self.checksum == (binascii.crc32(memoryview(buffer)[0:-4]) & 0xFFFFFFFF):
             raise IOError("Request header does not match checksum!") 
                 
 class Response:
     """
     Class representing a response received from the appliance.
     
-    The response header is 36 bytes:
+    The response header is 28 bytes:
         (4) command
         (4) status
-        (4) k
+        (4) count
         (4) elapsed
         (8) body_length
         (4) header checksum
     
     The body is received over the socket separately from the header.
-    First we receive 36 bytes to receive the header, then this tells us
+    First we receive 28 bytes to receive the header, then this tells us
     how many bytes to receive for the body.
     """
     
@@ -255,34 +510,62 @@ class Response:
         self.body = body
         self.body_checksum = 0
         
+        # Whether the distances in the body are float16 rather than float32.
+        self.float16 = False
+        
         # Store the header size to be referenced elsewhere in the code.
-        self.header_size = 28
+        self.header_size = _RESPONSE_HEADER.size
     
     def pack(self):
         """
         Pack the response into a byte array (Python string).
         """
         
+        # Join the pieces of the packet into a single buffer.
+        return b''.join(self.iov())
+
+    def iov(self):
+        """
+        Returns the binary representation of this response as a list of 
+        buffers (header, body, body checksum) which together make up the 
+        packet returned by 'pack'.
+        
+        The body is not copied, so the buffers can be sent with a single
+        scatter/gather write (socket.sendmsg) without first concatenating 
+        them.
+        
+        :rtype: list
+        :return: The packet buffers, in order.
+        """
+        
         # Pack the message header.        
         #   'L' is unsigned long (32-bit, 4 bytes)
         #   'Q' is unsigned long long (64-bit, 8 bytes)
         #   'f' is float (32-bit, 4 bytes)
-        buf = struct.pack("=LLLfQ", self.command, self.status, self.count, self.elapsed, self.body_length)
-        
-        #print('Header checksum: %d' % (binascii.crc32(buf) & 0xFFFFFFFF))        
+        # The fields and their checksum are written into a single header 
+        # buffer, rather than packing each and concatenating them.
+        buf = bytearray(_RESPONSE_HEADER.size)
+        command = (self.command | _FLOAT16) if self.float16 else self.command
+        _RESPONSE_FIELDS.pack_into(buf, 0, command, self.status, self.count, self.elapsed, self.body_length)
         
         # Add a checksum of the header fields.       
-        buf += struct.pack("=L", binascii.crc32(buf) & 0xFFFFFFFF)
+        fields = memoryview(buf)[0:_RESPONSE_FIELDS.size]
+        _U32.pack_into(buf, _RESPONSE_FIELDS.size, 
+                       binascii.crc32(fields) & 0xFFFFFFFF)
+
+        buffers = [buf]
 
-        # Append the packet payload.
+        # If this response includes a body...
         if self.body_length > 0 and self.body is not None:
-            buf += self.body
-        
-            # Add a checksum of the body just after the body.
-            buf += struct.pack("=L", binascii.crc32(self.body) & 0xFFFFFFFF)
+            
+            # Add the payload.
+            buffers.append(self.body)
+            
+            # Append a checksum to the end of the body.
+            buffers.append(_U32.pack(Common.crc32(self.body)))
         
-        # Return the constructed packet.
-        return buf
+        # Return the packet buffers.
+        return buffers
         
     def unpack_header(self, buffer):
         """
@@ -293,34 +576,64 @@ class Response:
         """
         # Parse the header fields.
         (self.command, self.status, self.count, self.elapsed, self.body_length, self.checksum) = \
-            struct.unpack_from("=LLLfQL", buffer, 0)
+            _RESPONSE_HEADER.unpack_from(buffer, 0)
+        
+        # Separate the float16 flag from the command.
+        self.float16 = bool(self.command & _FLOAT16)
+        self.command &= ~_FLOAT16
         
         # Validate the header checksum--compare the transmitted checksum to a
         # checksum of the header (minus the last four bytes of the header, 
-        # which are the transmitted checksum!)
-        if not self.checksum == (binascii.crc32(buffer[0:-4]) & 0xFFFFFFFF):
+        # which are the transmitted checksum!) The header is read through a
+        # memoryview so that it isn't copied.
+        if not self.checksum == (binascii.crc32(memoryview(buffer)[0:-4]) & 0xFFFFFFFF):
             raise IOError("Response header does not match checksum!") 
 
-    def pack_results(self, distances, indeces):
+    def pack_results(self, distances, indeces, float16=False):
         """
         Create and store a byte string representation of the results.
         
         Sets the 'body' and 'body_length' parameters of this object.
+        
+        :type float16: bool
+        :param float16: Send the distances as float16 (e.g., in reply to a 
+                        request whose vectors were sent as float16).
         """
+        self.float16 = float16
+        dists_dtype = 'float16' if float16 else 'float32'
        
-        # Store the dimensions of the results matrices first. 
-        self.body = struct.pack("=LL", distances.shape[0], distances.shape[1])
-       
+        # Results of any other type are converted to float32 / int32 as they 
+        # are copied into the body below, rather than by first making a
+        # converted copy of the whole matrix.
         if not distances.dtype == 'float32':
             print('WARNING: Distances matrix was not float32, converting.')
-            distances = distances.astype('float32')
         
         if not indeces.dtype == 'int32':
             print('WARNING: Indeces matrix was not int32, converting.')
-            indeces = indeces.astype('int32')
+        
+        # Size in bytes of each matrix on the wire.
+        dists_size = distances.size * np.dtype(dists_dtype).itemsize
+        idxs_size = indeces.size * 4
+        
+        # Allocate the whole body up front: the matrix dimensions, followed
+        # by the distances and then the indeces.
+        body = bytearray(_SHAPE.size + dists_size + idxs_size)
+       
+        # Store the dimensions of the results matrices first. 
+        _SHAPE.pack_into(body, 0, distances.shape[0], distances.shape[1])
        
-        # Use built in numpy methods to dump the results to bytes.
-        self.body += distances.tobytes() + indeces.tobytes()
+        # Copy each matrix directly into its place in the body, through a 
+        # numpy view of that region. Unlike 'tobytes', this copies the 
+        # results only once, and works for non-contiguous matrices too.
+        # For float32 / int32 matrices which are contiguous (the usual case)
+        # the copy is a single memcpy.
+        end = _SHAPE.size + dists_size
+        np.frombuffer(body, dtype=dists_dtype, count=distances.size, 
+                      offset=_SHAPE.size).reshape(distances.shape)[...] = distances
+        np.frombuffer(body, dtype='int32', count=indeces.size, 
+                      offset=end).reshape(indeces.shape)[...] = indeces
+        
+        self.body = body
                            
         # Store the length of the payload in bytes.
         self.body_length = len(self.body)
@@ -329,23 +642,33 @@ class Response:
         """
         Restore the results list from the byte string.
         
+        The distances are float16 if the response was packed with 
+        'float16=True', and float32 otherwise.
+        
         :rtype: numpy.ndarray
         :return: (distances, indeces)
         """
         
         # Unpack the matrix shape from the beginning of the body.
-        shape = struct.unpack_from("=LL", self.body)
+        shape = _SHAPE.unpack_from(self.body)
+        dists_dtype = 'float16' if self.float16 else 'float32'
         
         # Calculate the size of each result matrix in bytes.
         matrix_size = shape[0] * shape[1] * 4
+        dists_size = shape[0] * shape[1] * np.dtype(dists_dtype).itemsize
         
         start = 8
-        end = 8 + matrix_size
+        end = 8 + dists_size
+        
+        # Slice the body through a memoryview--slicing the body itself would
+        # copy each (potentially large) matrix before numpy ever sees it.
+        body = memoryview(self.body)
         
         # The first half of the body is the matrix of distances.
-        # Numpy implements a function for converting from bytes to ndarray.
-        distances = np.frombuffer(self.body[start:end], dtype='float32')
-        indeces = np.frombuffer(self.body[end:], dtype='int32')
+        # Numpy implements a function for converting from bytes to ndarray,
+        # and the resulting arrays are views of the received body.
+        distances = np.frombuffer(body[start:end], dtype=dists_dtype)
+        indeces = np.frombuffer(body[end:end + matrix_size], dtype='int32')
         
         # Reformat the result matrices to their original shape.
         distances = distances.reshape(shape)
@@ -0,0 +1,357 @@
+from common import Common, Request, Response, Status, Command, ChecksumError, _U32
+from gpuclient import GpuClient
+import asyncio
+import collections
+import socket
+import time
+import numpy as np
+
+class GpuAsyncClient:
+    """
+    asyncio version of GpuClient, for applications which serve many
+    concurrent query streams from one event loop.
+
+    Any number of coroutines can use the same client at once. Their requests
+    are written to the one connection as they're made, and a background task
+    reads the responses and hands each one back to the coroutine waiting for
+    it. The server answers a connection's requests in the order they're
+    sent, so responses are matched to requests by their order.
+
+    Usage:
+
+        c = GpuAsyncClient()
+        async with await c.open(host, port, api_key):
+            await c.load_dataset_file(file_name, dataset_name, metric='L2')
+            D, I = await c.query(vectors, k=10)
+    """
+
+    def __init__(self):
+
+        self.reader = None
+        self.writer = None
+        self.address = None
+
+        # Futures for the requests which have been sent and not yet answered,
+        # oldest first.
+        self.pending = collections.deque()
+
+        # Task which receives the responses.
+        self.receiver = None
+
+        # These variables hold the elapsed time of the previous action.
+        self.server_elapsed = 0
+        self.client_elapsed = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exception_type, exception_value, traceback):
+        """
+        Called on leaving the 'async with' block, whether or not there is an
+        exception. Closes the connection.
+        """
+        await self.close()
+
+        # Return False to re-raise any exception.
+        return False
+
+    async def open(self, host, port, api_key):
+        """
+        Open a connection to the Nearist appliance.
+
+        As with 'GpuClient.open', if 'host' is a file system path (starting
+        with '/'), a Unix domain socket is opened to that path instead of a
+        TCP connection, and TCP connections have Nagle's algorithm disabled.
+
+        :type host: string
+        :param host: IP address of the Nearist server, or the path of the
+                     server's Unix domain socket.
+
+        :type port: integer
+        :param port: Port number for accessing the Nearist server.
+
+        :type api_key: string
+        :param api_key: Unique user access key which is required to access the
+                        server.
+        """
+
+        # If 'host' is a path, connect to the server's Unix domain socket.
+        if host.startswith('/'):
+            self.reader, self.writer = await asyncio.open_unix_connection(host)
+            self.address = host
+        else:
+            self.reader, self.writer = await asyncio.open_connection(host, port)
+            self.address = (host, port)
+
+            # Send each request immediately (disable Nagle's algorithm).
+            sock = self.writer.get_extra_info('socket')
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        # Store the API key
+        self.api_key = api_key
+
+        # Start receiving responses.
+        self.receiver = asyncio.ensure_future(self.__receive_responses())
+
+        return self
+
+    async def close(self):
+        """
+        Close the connection to the Nearist appliance.
+        
+        Any requests still waiting for a response fail with an IOError.
+        """
+        if self.receiver is not None:
+            self.receiver.cancel()
+            self.receiver = None
+        
+        # Their responses won't be received now, so fail the requests still
+        # waiting for them rather than leaving them waiting forever.
+        while self.pending:
+            future = self.pending.popleft()
+            if not future.done():
+                future.set_exception(IOError("Connection closed."))
+
+        # The connection may never have been opened (or 'open' failed).
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+            self.writer = None
+            self.reader = None
+
+    async def __receive(self):
+        """
+        Helper function to receive the next response from the server.
+
+        :rtype: Common.Response
+        :return: The response object with the response body and decoded header.
+        """
+
+        # Receive and unpack the response header.
+        resp = Response()
+        buf = await self.reader.readexactly(resp.header_size)
+        resp.unpack_header(buf)
+
+        # If the response includes a payload, receive it along with its
+        # checksum, and verify the checksum.
+        if resp.body_length > 0:
+            buf = await self.reader.readexactly(resp.body_length + _U32.size)
+            body = memoryview(buf)[0:resp.body_length]
+
+            expected = _U32.unpack_from(buf, resp.body_length)[0]
+            if not expected == Common.crc32(body):
+                raise ChecksumError("Response payload does not match checksum!")
+
+            resp.body = body
+
+        return resp
+
+    async def __receive_responses(self):
+        """
+        Background task which receives each response and passes it to the
+        request waiting for it.
+        """
+        try:
+            while True:
+                resp = await self.__receive()
+
+                future = self.pending.popleft()
+
+                # Pass a bad status to the request as an error. The
+                # connection is closed, as in 'GpuClient'.
+                if resp.status != Status.SUCCESS:
+                    # Forget the loaded dataset, as in 'GpuClient'.
+                    GpuClient.loaded_datasets.pop(self.address, None)
+                    
+                    error = IOError("Nearist error: %s " % Status(resp.status))
+                    if not future.done():
+                        future.set_exception(error)
+                    raise error
+
+                if not future.done():
+                    future.set_result(resp)
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception as e:
+            # The connection can't be used any more. Fail all of the
+            # requests still waiting for a response.
+            if isinstance(e, asyncio.IncompleteReadError):
+                e = IOError("Received 0 bytes from server, connection closed.")
+
+            while self.pending:
+                future = self.pending.popleft()
+                if not future.done():
+                    future.set_exception(e)
+
+            self.writer.close()
+
+    async def __request(self, request):
+        """
+        Helper function to send a request to the server and wait for the
+        response.
+
+        :type request: Common.Request
+        :param request: The Request object specifying the command to be sent
+                        to the server.
+
+        :rtype: Common.Response
+        :return: The response object with the response body and decoded header.
+        """
+        if self.receiver is None or self.receiver.done():
+            raise IOError("Connection is closed.")
+
+        # Queue the request's buffers to be written, and register for its
+        # response. No other coroutine can run in between, so the order of
+        # 'pending' matches the order the requests are sent in.
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(future)
+        self.writer.writelines(request.iov())
+
+        # Wait for the request to be sent (if the socket is backed up), and
+        # then for its response.
+        await self.writer.drain()
+        return await future
+
+    async def load_dataset_file(self, file_name, dataset_name='', metric='L2',
+                                reload=False):
+        """
+        Load dataset which is already on the Nearist server hard disk.
+
+        See 'GpuClient.load_dataset_file'. Which dataset is loaded on each
+        server is shared with the GpuClient instances in this process.
+        """
+
+        # Record the start time.
+        t0 = time.time()
+
+        # Skip the load if this dataset is already in GPU memory.
+        dataset = (file_name, dataset_name, metric)
+        if not reload and GpuClient.loaded_datasets.get(self.address) == dataset:
+            self.server_elapsed = 0
+            self.client_elapsed = time.time() - t0
+            return
+
+        # Forget the previously loaded dataset--if this load fails, we don't
+        # know what the server has loaded.
+        GpuClient.loaded_datasets.pop(self.address, None)
+
+        # Construct a load request.
+        req = Request(
+            api_key = self.api_key,
+            command = Command.LOAD_DATASET_FILE,
+        )
+
+        # Send the filename and dataset name as the packet payload.
+        req.pack_json({
+            "fileName": file_name,
+            "datasetName": dataset_name,
+            "metric": metric
+        })
+
+        resp = await self.__request(req)
+
+        # Remember what's loaded.
+        GpuClient.loaded_datasets[self.address] = dataset
+
+        # Record the elapsed server time, and the elapsed time from the
+        # client's perspective.
+        self.server_elapsed = resp.elapsed
+        self.client_elapsed = time.time() - t0
+
+    async def __query_batch(self, vectors, k):
+        """
+        Helper function to query one batch of vectors (or a single vector).
+
+        :rtype: tuple
+        :return: (distances, indeces, server elapsed time)
+        """
+        req = Request(
+            api_key = self.api_key,
+            command = Command.QUERY,
+            k = k
+        )
+
+        # The request's payload refers to 'vectors' until it has been sent;
+        # converting here gives it its own copy if the caller's vectors
+        # aren't already contiguous float32.
+        req.pack_vectors(np.ascontiguousarray(vectors, dtype=np.float32))
+
+        resp = await self.__request(req)
+
+        D, I = resp.unpack_results()
+
+        if not I.shape[0] == (1 if vectors.ndim == 1 else vectors.shape[0]):
+            raise IOError('Query length %d does not match results length %d!' % (len(vectors), I.shape[0]))
+
+        return D, I, resp.elapsed
+
+    async def query(self, vectors, k=10, batch_size=128, pipeline_depth=2):
+        """
+        Submit a k-nearest neighbor search to the server.
+
+        See 'GpuClient.query'. A matrix of vectors is submitted in
+        mini-batches of 'batch_size', with up to 'pipeline_depth' of them
+        in flight at once.
+
+        The vectors must not be modified until the query returns.
+
+        :rtype: tuple
+        :return: (distances, indeces). These are both matrices with shape
+                 [num queries x k]; float32 and int32 respectively.
+        """
+
+        # Record the start time.
+        t0 = time.time()
+
+        # Validate the type of the vectors object.
+        if not type(vectors) == np.ndarray:
+            raise IOError("Query vectors should be of type numpy.ndarray")
+
+        # A single query vector.
+        if vectors.ndim == 1:
+            D, I, server_elapsed = await self.__query_batch(vectors, k)
+
+            self.server_elapsed = server_elapsed
+            self.client_elapsed = time.time() - t0
+            return D, I
+
+        elif not vectors.ndim == 2:
+            raise IOError("'vectors' argument has wrong number of dimensions!")
+
+        # Record the total number of query vectors.
+        num_vecs = vectors.shape[0]
+
+        # Verify there's at least one vector.
+        if num_vecs == 0:
+            raise IOError("Number of query vectors cannot be zero!")
+
+        # Preallocate the result matrices and fill them in batch by batch.
+        D_all = np.empty((num_vecs, k), dtype=np.float32)
+        I_all = np.empty((num_vecs, k), dtype=np.int32)
+
+        # Limits the number of mini-batches in flight.
+        window = asyncio.Semaphore(pipeline_depth)
+
+        async def query_batch(start):
+            end = min(start + batch_size, num_vecs)
+
+            async with window:
+                D, I, server_elapsed = \
+                    await self.__query_batch(vectors[start:end, :], k)
+
+            D_all[start:end] = D
+            I_all[start:end] = I
+            return server_elapsed
+
+        # Submit all of the mini-batches, and wait for them to complete.
+        elapsed = await asyncio.gather(*[query_batch(start) for start in
+                                         range(0, num_vecs, batch_size)])
+
+        # Record the total time spent on the server, and the total time
+        # observed by the client.
+        self.server_elapsed = sum(elapsed)
+        self.client_elapsed = time.time() - t0
+
+        return D_all, I_all
@@ -1,21 +1,87 @@
-from common import Request, Response, Status, Command
+from common import Common, Request, Response, Status, Command, ChecksumError
+import concurrent.futures
+import gc
 import sys
 import socket
+import threading
 import time
-import struct
 import numpy as np
-import binascii
+
+# Plain integer copies of the enum values used for every mini-batch, so the
+# hot loops don't go through the enum machinery to look them up.
+_SUCCESS = int(Status.SUCCESS)
+_QUERY = int(Command.QUERY)
+
+# Flag asking 'recv_into' to wait for the full amount requested, where the 
+# platform supports it.
+_MSG_WAITALL = getattr(socket, 'MSG_WAITALL', 0)
+
+# Number of seconds a resolved server address is reused before it's looked
+# up again.
+_ADDRESS_TTL = 60
+
+# Minimum number of seconds between the progress updates printed by a 
+# verbose query.
+_PROGRESS_INTERVAL = 0.5
+
+# Progress update formats, for time estimates given in seconds and minutes.
+_PROGRESS_SEC = '  Query %5d / %5d (%3.0f%%) Time Remaining: ~%.0f sec...'
+_PROGRESS_MIN = '  Query %5d / %5d (%3.0f%%) Time Remaining: ~%.0f min...'
 
 class GpuClient:
     """
     This class provides the Python interface for communicating with the Nearist appliances.
 
     Commands are communicated via TCP/IP to the server.
+    
+    A client (and its connection) should only be used by one thread at a 
+    time, but separate clients can be used from separate threads. Their 
+    network I/O and checksums release the GIL, so e.g. one client per server
+    can be driven from a thread pool.
     """
 
+    # The dataset most recently loaded on each server by this process, as a
+    # (file_name, dataset_name, metric) tuple keyed by server address. This
+    # is shared by all GpuClient instances so that re-running a script 
+    # (which creates a new client) doesn't reload the same dataset.
+    loaded_datasets = {}
+    
+    # The resolved (family, socket address, expiry time) of each (host, 
+    # port) which has been connected to, so that re-opening a connection 
+    # within '_ADDRESS_TTL' seconds doesn't repeat the DNS lookup.
+    resolved_addresses = {}
+
     def __init__(self):
         
         self.sock = None
+        self.address = None
+        
+        # Sizes of the socket's kernel send and receive buffers (see 'open').
+        self.sndbuf = 0
+        self.rcvbuf = 0
+        
+        # Whether to re-enable TCP_QUICKACK before receiving each response
+        # (see 'open').
+        self.quickack = False
+        
+        # Buffer which each response header is received into. Headers are
+        # parsed as soon as they arrive, so one buffer is reused for all of
+        # them.
+        self.header_buf = bytearray(Response().header_size)
+        
+        # Buffer which response bodies are received into, when their results
+        # are copied out before the next response is received (see 
+        # '__receive'). It's grown to fit the largest body seen so far.
+        self.body_buf = None
+        
+        # Set this to True to send query vectors as float16, which halves 
+        # the amount of data sent. This requires a server which supports 
+        # float16 vectors.
+        self.float16 = False
+        
+        # Single worker thread which runs the queries submitted with 
+        # 'query_async'. It's created on first use.
+        self.executor = None
         
         # These variables hold the elapsed time of the previous action.
         self.server_elapsed = 0
@@ -40,30 +106,116 @@ class GpuClient:
             return True
 
     @staticmethod
-    def __recvall(sock, length):
+    def __recvall(sock, length, data=None):
         """
         Helper function to receive 'length' bytes or return None if EOF is hit.
+        
+        The bytes are received into 'data' if it's given (it must be at least
+        'length' bytes), so that a buffer can be reused between calls.
         """
          
-        data = bytearray()
+        # Allocate the full buffer up front and have the socket write directly
+        # into it, rather than growing a bytearray with each received packet.
+        if data is None:
+            data = bytearray(length)
+        view = memoryview(data)
+        received = 0
 
         # Loop until we've received 'length' bytes.        
-        while len(data) < length:
+        while received < length:
 
-            # Receive the remaining bytes. The amount of data returned might
-            # be less than 'length'.
-            packet = sock.recv(length - len(data))
+            # Receive the remaining bytes into the unfilled part of the 
+            # buffer. MSG_WAITALL asks the kernel to wait until all of them
+            # have arrived, so this normally takes a single call, but the 
+            # amount of data returned might still be less than 'length' 
+            # (e.g., if the call is interrupted by a signal).
+            num_bytes = sock.recv_into(view[received:], length - received, 
+                                       _MSG_WAITALL)
 
             # If we received 0 bytes, the connection has been closed...            
-            if not packet:
+            if not num_bytes:
                 return None
 
-            # Append the received bytes to 'data'.    
-            data += packet
+            # Advance past the received bytes.
+            received += num_bytes
 
         # Return the 'length' bytes of received data.
         return data
 
+    @staticmethod
+    def __sendall(sock, buffers):
+        """
+        Helper function to send all of the bytes in the list of 'buffers'.
+        
+        The buffers are sent with scatter/gather writes ('sendmsg'), so the
+        request header and the (potentially large) vector payload go out 
+        together without first being copied into one buffer.
+        """
+        
+        # 'sendmsg' isn't available on all platforms (e.g., Windows), so fall
+        # back to sending the concatenated buffers.
+        if not hasattr(sock, 'sendmsg'):
+            sock.sendall(b''.join(buffers))
+            return
+        
+        # View the buffers as raw bytes so they can be sliced by byte offset.
+        views = [memoryview(b).cast('B') for b in buffers]
+        
+        # Loop until all of the buffers have been sent.
+        while views:
+            
+            # Send as much as possible. This may not send everything.
+            num_bytes = sock.sendmsg(views)
+            
+            # Drop the buffers which were sent completely...
+            while views and num_bytes >= len(views[0]):
+                num_bytes -= len(views[0])
+                views.pop(0)
+            
+            # ...and the part of the next one that was sent.
+            if num_bytes:
+                views[0] = views[0][num_bytes:]
+
+    @staticmethod
+    def __auto_batch_size(num_vecs, num_batches, client_elapsed, 
+                          server_elapsed):
+        """
+        Helper function to choose a query batch size from the timing of a 
+        query of 'num_vecs' vectors sent in 'num_batches' batches.
+        
+        Each batch has a roughly fixed overhead (the network round trip, 
+        packing, etc.), while the server's time grows with the number of 
+        vectors. The batch size is chosen so that the overhead is about 10% 
+        of the server's time for each batch, within the range 32 - 4,096.
+        """
+        
+        # The overhead of each batch, and the server time per query vector.
+        overhead = max(client_elapsed - server_elapsed, 0) / num_batches
+        per_vector = server_elapsed / num_vecs
+        
+        if per_vector <= 0:
+            return 4096
+        
+        return int(max(32, min(4096, overhead / (0.1 * per_vector))))
+
+    @staticmethod
+    def __check_vectors(vectors):
+        """
+        Helper function to validate query vectors.
+        
+        Vectors which aren't float32 (or aren't C-contiguous) are converted to
+        the layout the server expects as they are sent, one mini-batch at a 
+        time, rather than by first copying the whole matrix.
+        """
+        
+        # Validate the type of the vectors object.
+        if not type(vectors) == np.ndarray:
+            raise IOError("Query vectors should be of type numpy.ndarray")
+        
+        # Warn if the vectors aren't type float32 as the server expects.
+        if not vectors.dtype == np.float32:
+            print("WARNING - Vectors are type %s but should be float32." \
+                  " Casting vectors to float32." % str(vectors.dtype))
 
     def __request(self, request):
         """
@@ -79,18 +231,48 @@ class GpuClient:
         """
         
         # Format the packet and send it to the server.
-        # 'sendall' will send all bytes in the request before returning.        
-        status = self.sock.sendall(request.pack())
+        GpuClient.__sendall(self.sock, request.iov())
+        
+        # Wait for and return the response.
+        try:
+            return self.__receive()
+        
+        # If the response body was corrupted, the whole of it was still 
+        # received, so the connection is still in step with the server. 
+        # Rather than giving up on the connection, send the request once more.
+        except ChecksumError:
+            GpuClient.__sendall(self.sock, request.iov())
+            return self.__receive()
 
-        # Check for status ('sendall' returns None if successful.)
-        if status is not None:
-            raise IOError("Transmission failure: %s" % str(status))
+    def __receive(self, reuse_body=False):
+        """
+        Helper function to receive the response to the oldest request which
+        has been sent to the server and not yet answered.
+        
+        The server answers requests in the order they are sent, so several
+        requests can be sent before their responses are received.
+        
+        :type reuse_body: bool
+        :param reuse_body: Receive the body into the client's 'body_buf' 
+                           rather than a newly allocated buffer. The body 
+                           (and any arrays unpacked from it) is then only 
+                           valid until the next response is received.
+        
+        :rtype: Common.Response
+        :return: The response object with the response body and decoded header.
+        """
         
         # Receive the response header.
         # This call will block until the server has finished processing the
         # request and has sent a response.
         resp = Response()
-        buf = GpuClient.__recvall(self.sock, resp.header_size)
+        
+        # Acknowledge the response's packets immediately. Linux clears this
+        # option by itself, so it's set again for each response.
+        if self.quickack:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+        
+        buf = GpuClient.__recvall(self.sock, resp.header_size, self.header_buf)
         
         # Verify the buffer was received.
         if buf is None:
@@ -100,34 +282,68 @@ class GpuClient:
         resp.unpack_header(buf)
 
         # Check for bad status.            
-        if resp.status != Status.SUCCESS:
-            # Close the connection.
-            self.close()
+        if resp.status != _SUCCESS:
+            # Close the connection. Only the socket is closed--this may be
+            # running on the 'query_async' worker thread, which 'close' 
+            # would try to join.
+            self.sock.close()
+            
+            # The error may mean the server no longer has the dataset we 
+            # think it has (e.g., it was restarted), so forget it. The next
+            # 'load_dataset_file' then loads it again.
+            GpuClient.loaded_datasets.pop(self.address, None)
             
             # Raise the error received.
             raise IOError("Nearist error: %s " % Status(resp.status))
         
         # If the response includes a payload, receive it.
         if resp.body_length > 0:
-            # Receive the body of this response.
-            resp.body = GpuClient.__recvall(self.sock, resp.body_length)
-
-            # Receive the body checksum
-            checksum = GpuClient.__recvall(self.sock, 4)
+            # Use the shared body buffer if requested, growing it first if
+            # this body (plus its 4 byte checksum) doesn't fit.
+            data = None
+            if reuse_body:
+                if self.body_buf is None or len(self.body_buf) < resp.body_length + 4:
+                    self.body_buf = bytearray(resp.body_length + 4)
+                data = self.body_buf
+            
+            # Receive the body of this response, verifying its checksum.
+            resp.body = Common.receive_body(self.sock, resp.body_length, data)
 
-            # Verify the checksum.
-            if not checksum == struct.pack("=L", binascii.crc32(resp.body) & 0xFFFFFFFF):
-                raise IOError("Response payload does not match checksum!")
+            if resp.body is None:
+                raise IOError("Received 0 bytes from server, connection closed.")
             
         # Return the Response object.
         return resp
 
-    def open(self, host, port, api_key):
+    def open(self, host, port, api_key, sndbuf=4 * 1024 * 1024, 
+             rcvbuf=4 * 1024 * 1024):
         """
         Open a socket for communication with the Nearist appliance.
         
+        If 'host' is a file system path (starting with '/'), a Unix domain
+        socket is opened to that path instead of a TCP connection. This 
+        bypasses the TCP stack when the server runs on the same machine; 
+        'port' is ignored in this case.
+        
+        TCP connections have Nagle's algorithm disabled (TCP_NODELAY), since
+        each request is a small header followed by a payload and then waits
+        for the response--holding back the tail of the request would only add
+        latency. On Linux, delayed ACKs are also turned off for each response
+        (TCP_QUICKACK). TCP connections enable keep-alive probes, and the 
+        address lookup for each host is cached. 
+        
+        Both connection types use enlarged (4 MB by default) kernel send and
+        receive buffers for the large vector and result payloads. The kernel
+        may limit these (on Linux, to net.core.wmem_max and 
+        net.core.rmem_max); the sizes actually granted are stored in the 
+        'sndbuf' and 'rcvbuf' properties. For fast (10 Gb/s and up) links, 
+        raising those limits and using the 'fq' queueing discipline on the
+        client's interface (e.g., 'tc qdisc replace dev eth0 root fq') helps
+        a single connection reach full throughput.
+        
         :type host: string
-        :param host: IP address of the Nearist server.
+        :param host: IP address of the Nearist server, or the path of the
+                     server's Unix domain socket.
         
         :type port: integer
         :param port: Port number for accessing the Nearist server.
@@ -135,18 +351,81 @@ class GpuClient:
         :type api_key: string
         :param api_key: Unique user access key which is required to access the
                         server.
+        
+        :type sndbuf: integer
+        :param sndbuf: Requested size in bytes of the socket's send buffer.
+        
+        :type rcvbuf: integer
+        :param rcvbuf: Requested size in bytes of the socket's receive buffer.
 
         """
 
-        # Convert the host name and port to a 5-tuple of arguments.
-        # We just need the "address family" parameter.
-        address_info = socket.getaddrinfo(host, port)
+        # If 'host' is a path, connect to the server's Unix domain socket.
+        if host.startswith('/'):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            address = sockaddr = host
+            self.quickack = False
+        else:
+            address = (host, port)
+            
+            # Convert the host name and port to a 5-tuple of arguments.
+            # We need the "address family" and the resolved socket address,
+            # which are cached. Connecting to the resolved address (rather 
+            # than the host name) means 'connect' doesn't look it up again.
+            resolved = GpuClient.resolved_addresses.get(address)
+            if resolved is None or resolved[2] < time.time():
+                info = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+                resolved = (info[0], info[4], time.time() + _ADDRESS_TTL)
+                GpuClient.resolved_addresses[address] = resolved
+            family, sockaddr = resolved[0], resolved[1]
 
-        # Create a new socket (the host and port are specified in 'connect').
-        self.sock = socket.socket(address_info[0][0], socket.SOCK_STREAM)
+            # Create a new socket (the address is specified in 'connect').
+            self.sock = socket.socket(family, socket.SOCK_STREAM)
 
-        # Connect to the host.
-        self.sock.connect((host, port))
+            # Send each request immediately rather than waiting to coalesce
+            # it with more data (disable Nagle's algorithm).
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            
+            # Have the OS probe the connection after 30 seconds of idle time
+            # (where supported), so that a connection kept open between
+            # queries, e.g. in an interactive session, isn't silently 
+            # dropped by a firewall or NAT, and a dead server is noticed. 
+            # Probes are sent every 10 seconds, and the connection is 
+            # dropped after 3 go unanswered.
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30)
+            if hasattr(socket, 'TCP_KEEPINTVL'):
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+            if hasattr(socket, 'TCP_KEEPCNT'):
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+            
+            # On Linux, don't delay the ACKs for the server's responses 
+            # either (TCP_QUICKACK), so the server's sends aren't held up
+            # waiting on them.
+            self.quickack = hasattr(socket, 'TCP_QUICKACK')
+
+        # Enlarge the kernel send and receive buffers so that large query
+        # vectors and results move in bigger pieces per system call.
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        
+        # Record the buffer sizes the kernel actually granted. (Linux 
+        # reports double the usable size, to account for its bookkeeping.)
+        self.sndbuf = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+        self.rcvbuf = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+        # Connect to the host. If a resolved address can't be connected to,
+        # forget it so that the next attempt looks the host up again, and
+        # close the socket.
+        try:
+            self.sock.connect(sockaddr)
+        except Exception:
+            GpuClient.resolved_addresses.pop(address, None)
+            self.sock.close()
+            self.sock = None
+            raise
+        self.address = address
 
         # Store the API key        
         self.api_key = api_key
@@ -156,10 +435,17 @@ class GpuClient:
     def close(self):
         """
         Close the socket to the Nearist appliance.
+        
+        Any queries submitted with 'query_async' are completed first.
         """
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        
         self.sock.close()
             
-    def load_dataset_file(self, file_name, dataset_name='', metric='L2'):
+    def load_dataset_file(self, file_name, dataset_name='', metric='L2', 
+                          reload=False):
         """
         Load dataset which is already on the Nearist server hard disk.
         
@@ -175,6 +461,12 @@ class GpuClient:
         L2). The inner product is used for cosine similarity; all vectors
         (dataset and query vectors) should be normalized first.
         
+        If this process has already loaded the same file, dataset, and metric
+        on this server, the load is skipped (unless 'reload' is True). This 
+        is forgotten as soon as the server returns an error status for any 
+        request. Use 'reload' if something else may have loaded a different
+        dataset on the server in the meantime.
+        
         :type file_name: string
         :param file_name: Path to the dataset file on the Nearist server.
         
@@ -183,12 +475,27 @@ class GpuClient:
 
         :type metric: string
         :param metric: 'L2' distance or 'IP' inner product similarity.
+        
+        :type reload: bool
+        :param reload: Load the dataset even if it appears to be loaded 
+                       already.
 
         """
 
         # Record the start time.
         t0 = time.time()
         
+        # Skip the load if this dataset is already in GPU memory.
+        dataset = (file_name, dataset_name, metric)
+        if not reload and GpuClient.loaded_datasets.get(self.address) == dataset:
+            self.server_elapsed = 0
+            self.client_elapsed = time.time() - t0
+            return
+        
+        # Forget the previously loaded dataset--if this load fails, we don't
+        # know what the server has loaded.
+        GpuClient.loaded_datasets.pop(self.address, None)
+        
         # Construct a load request.
         req = Request(
             api_key = self.api_key,
@@ -206,13 +513,17 @@ class GpuClient:
         # Submit the request (__request handles the response status).
         resp = self.__request(req)
         
+        # Remember what's loaded.
+        GpuClient.loaded_datasets[self.address] = dataset
+        
         # Record the elapsed server time, and the elapsed time from the 
         # client's perspective.
         self.server_elapsed = resp.elapsed
         self.client_elapsed = time.time() - t0
 
 
-    def query(self, vectors, k=10, batch_size=128, verbose=False):
+    def query(self, vectors, k=10, batch_size=128, verbose=False, 
+              pipeline_depth=2, dtype=np.float32):
         """
         Submit a k-nearest neighbor search to the server.
         
@@ -226,37 +537,57 @@ class GpuClient:
         batches for you, and print progress updates if 'verbose' is true.
         
         :type vectors: numpy.ndarray
-        :param vectors: Matrix of query vectors, one per row. 
+        :param vectors: Matrix of query vectors, one per row. These should be
+                        a C-contiguous float32 array; anything else is 
+                        converted a mini-batch at a time as it's sent.
 
         :type k: int
         :param k: The number of nearest neighbors to find.
         
         :type batch_size: int
         :param batch_size: Sub-divide the 'vectors' into smaller batches in
-                           order to receive progress updates.
+                           order to receive progress updates. If this is 
+                           None, the first two batches of 128 are timed, and
+                           the rest of the vectors are sent in batches large
+                           enough that the per-batch overhead (the network
+                           round trip, etc.) is about 10% of the time spent 
+                           on the server.
         
         :type verbose: bool
         :param verbose: Print progress updates for queries consisting of 
-                        multiple batches.
+                        multiple batches (at most twice a second).
+        
+        :type pipeline_depth: int
+        :param pipeline_depth: Maximum number of batches in flight at once
+                               (see 'query_batches').
+        
+        :type dtype: numpy.dtype
+        :param dtype: Data type of the returned distances. The server 
+                      computes them in float32; pass e.g. numpy.float64 if 
+                      you need them widened.
                         
         :returns: (distances, indeces). These are both matrices with shape 
                   [num queries x k]. That is, one row per query vector and one
                   column per nearest neighbor.
         """
+        return self.__query(vectors, k, batch_size, verbose, pipeline_depth,
+                            dtype)
+    
+    def __query(self, vectors, k, batch_size, verbose, pipeline_depth, dtype,
+                pause_gc=True):
+        """
+        Implements 'query'.
+        
+        If 'pause_gc' is False, the garbage collector is left running during
+        the query. 'query_async' passes False, since the caller's own thread
+        keeps working while the query runs.
+        """
         
         # Record the start time.
         t0 = time.time()
         
-        # Validate the type of the vectors object.
-        if not type(vectors) == np.ndarray:
-            raise IOError("Query vectors should be of type numpy.ndarray")
-        
-        # Ensure vectors are type float32 as the server expects.
-        if not vectors.dtype == np.float32:
-            print("WARNING - Vectors are type %s but should be float32." \
-                  " Casting vectors to float32." % str(vectors.dtype))
-            # Cast the vectors float32 if they aren't already.      
-            vectors = vectors.astype('float32')
+        # Validate the vectors.
+        GpuClient.__check_vectors(vectors)
         
         # Reset the elapsed time measurements.
         self.server_elapsed = 0
@@ -268,6 +599,9 @@ class GpuClient:
         
         # If 'vectors' is just a single query vector...
         if vectors.ndim == 1:
+            # Cast the vector to float32 if it isn't already.
+            vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+            
             # Construct the query request.
             req = Request(
                 api_key = self.api_key,
@@ -276,13 +610,14 @@ class GpuClient:
             )
             
             # Add the vector.
-            req.pack_vectors(vectors)
+            req.pack_vectors(vectors, float16=self.float16)
         
             # Submit the query and wait for the results.
             resp = self.__request(req)
             
             # Unpack the results and return them.
             D, I = resp.unpack_results()
+            D = D.astype(dtype, copy=False)
 
             # Record the time spent on the server and the total time observed
             # by the client.
@@ -295,86 +630,407 @@ class GpuClient:
         #       Handle multiple queries 
         # =================================
         elif vectors.ndim == 2:
-            # Transmit the queries in mini-batches in order to avoid memory errors
-            # and to get progress updates.
-            
             # Record the total number of query vectors.                       
             num_vecs = vectors.shape[0]
 
-            # Verify there's at least one vector.
-            if num_vecs == 0:
-                raise IOError("Number of query vectors cannot be zero!")
+            # Preallocate the result matrices and fill them in batch by batch.
+            # Growing them with 'np.concatenate' would re-copy all of the
+            # results received so far on every mini-batch. By default the 
+            # dtypes match what the server sends (float32 distances, int32 
+            # indeces).
+            D_all = np.empty((num_vecs, k), dtype=dtype)
+            I_all = np.empty((num_vecs, k), dtype=np.int32)
             
-            D_all = np.zeros((0, k))
-            I_all = np.zeros((0, k), dtype='int32')
+            # The row of 'vectors' at which the (remaining) mini-batches start.
+            first = 0
+            probe_elapsed = 0
             
-            start = 0
+            # To choose the batch size automatically, first query two 
+            # batches of 128 one at a time and measure them.
+            if batch_size is None:
+                batch_size = 128
+                first = min(2 * batch_size, num_vecs)
+                
+                t1 = time.time()
+                for start, D, I in self.__query_batches(vectors[0:first, :], 
+                                                        k, batch_size, False, 1,
+                                                        reuse_body=True):
+                    D_all[start:start + D.shape[0]] = D
+                    I_all[start:start + D.shape[0]] = I
+                
+                probe_elapsed = self.server_elapsed
+                num_batches = (first + batch_size - 1) // batch_size
+                batch_size = GpuClient.__auto_batch_size(
+                    first, num_batches, time.time() - t1, probe_elapsed)
+                
+                if verbose:
+                    print('  Using a batch size of %d.' % batch_size)
             
-            # For each mini-batch...
-            while start < num_vecs:
-                # Calculate the 'end' of this mini-batch.
-                end = min(start + batch_size, num_vecs)
+            # Pause the garbage collector while the mini-batches are in 
+            # flight. Each batch allocates a few short-lived objects, which 
+            # would otherwise trigger collections (of everything the caller
+            # has allocated) partway through a large query. None of these
+            # objects form reference cycles, so they're freed as usual.
+            gc_was_enabled = gc.isenabled()
+            if pause_gc and num_vecs > batch_size:
+                gc.disable()
+            
+            try:
+                # Copy each mini-batch's results into their rows of the 
+                # output matrices as they arrive. Since they're copied out 
+                # straight away, every batch is received into the same 
+                # buffer.
+                if first < num_vecs:
+                    for start, D, I in self.__query_batches(
+                            vectors, k, batch_size, verbose, pipeline_depth, 
+                            first, reuse_body=True):
+                        end = start + D.shape[0]
+                        D_all[start:end] = D
+                        I_all[start:end] = I
+            finally:
+                if gc_was_enabled:
+                    gc.enable()
+            
+            # Record the total time spent on the server (including any 
+            # batches used to choose the batch size), and the total time 
+            # observed by the client.
+            if first < num_vecs:
+                self.server_elapsed += probe_elapsed
+            self.client_elapsed = time.time() - t0
+            
+            return D_all, I_all
+        
+        # If vectors.ndim is not 1 or 2, then somethings wrong with it.
+        else:
+            raise IOError("'vectors' argument has wrong number of dimensions!")
+    
+    def query_batches(self, vectors, k=10, batch_size=128, verbose=False,
+                      pipeline_depth=2):
+        """
+        Generator version of 'query' which yields the results one mini-batch 
+        at a time, as they are received from the server.
+        
+        Use this instead of 'query' when the full result matrices are too
+        large to hold in memory, e.g., to write each batch of results to disk
+        before the next batch is requested:
+        
+            for start, D, I in c.query_batches(vectors, k=10):
+                out_dists[start:start + len(D)] = D
+                out_idxs[start:start + len(I)] = I
+        
+        The mini-batches are pipelined: a background thread keeps up to 
+        'pipeline_depth' requests in flight, so the next batch is already on
+        its way to (or queued at) the server while the previous one is being
+        processed and its results received. This hides the network round
+        trip behind the server's compute time. A 'pipeline_depth' of 1 sends
+        each batch only after the previous batch's results have arrived.
+        
+        The timing measurements ('server_elapsed' and 'client_elapsed') are
+        complete once the generator has been exhausted.
+        
+        :type vectors: numpy.ndarray
+        :param vectors: Matrix of query vectors, one per row. 
+
+        :type k: int
+        :param k: The number of nearest neighbors to find.
+        
+        :type batch_size: int
+        :param batch_size: Number of query vectors to submit at a time.
+        
+        :type verbose: bool
+        :param verbose: Print progress updates between batches (at most 
+                        twice a second).
+        
+        :type pipeline_depth: int
+        :param pipeline_depth: Maximum number of batches in flight at once.
+                        
+        :returns: Yields (start, distances, indeces) for each mini-batch, 
+                  where 'start' is the row in 'vectors' of the first query in
+                  the batch, and the results have shape [batch length x k].
+        """
+        
+        # Validate the vectors.
+        GpuClient.__check_vectors(vectors)
+        
+        return self.__query_batches(vectors, k, batch_size, verbose, 
+                                    pipeline_depth)
     
-                # Select the vectors in this mini-batch.
-                mini_batch = vectors[start:end, :]
+    def query_async(self, vectors, k=10, batch_size=128, pipeline_depth=2,
+                    dtype=np.float32):
+        """
+        Submit a k-nearest neighbor search to the server without waiting for
+        the results.
+        
+        This lets the caller prepare its next batch of query vectors (or
+        process the previous results) while the server works on this one:
+        
+            future = c.query_async(vectors, k=10)
+            next_vectors = prepare(...)
+            distances, indeces = future.result()
+        
+        The query is run by 'query' on a worker thread belonging to this 
+        client. Queries submitted while another is running wait their turn,
+        so they're run in the order they were submitted, each with at most 
+        'pipeline_depth' mini-batches in flight. Until all of them are 
+        done, don't use this client in any other way, and don't modify the
+        submitted vectors. The 'server_elapsed' and 'client_elapsed' 
+        timings refer to whichever query finished last. Unlike 'query', the
+        garbage collector isn't paused while the query runs.
+        
+        See 'query' for the parameters.
+        
+        :rtype: concurrent.futures.Future
+        :return: A future whose result is (distances, indeces).
+        """
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        
+        # Leave the garbage collector running (see '__query').
+        return self.executor.submit(self.__query, vectors, k, batch_size, 
+                                    False, pipeline_depth, dtype, False)
     
-                # Progress update.
-                if verbose and not start == 0:
+    def __query_batches(self, vectors, k, batch_size, verbose, pipeline_depth,
+                        first=0, reuse_body=False):
+        """
+        Implements 'query_batches', for vectors which have been validated.
+        
+        Only the vectors from row 'first' onwards are queried. If 
+        'reuse_body' is True, every response is received into the same 
+        buffer (see '__receive'), so each batch's results must be copied 
+        before the next batch is requested from the generator.
+        """
+        
+        # Record the start time.
+        t0 = time.time()
+        
+        if not vectors.ndim == 2:
+            raise IOError("'vectors' argument has wrong number of dimensions!")
+        
+        # Reset the elapsed time measurements.
+        self.server_elapsed = 0
+        self.client_elapsed = 0       
+        
+        # Transmit the queries in mini-batches in order to avoid memory errors
+        # and to get progress updates.
+        
+        # Record the total number of query vectors.                       
+        num_vecs = vectors.shape[0]
+
+        # Verify there's at least one vector.
+        if num_vecs == 0:
+            raise IOError("Number of query vectors cannot be zero!")
+        
+        # The starting row of each mini-batch.
+        starts = range(first, num_vecs, batch_size)
+        
+        # The sender thread takes a slot in the window before sending each
+        # batch, and the receiver frees it once that batch's response is in.
+        window = threading.Semaphore(pipeline_depth)
+        stop = threading.Event()
+        
+        # Number of batches sent, and any error hit while sending.
+        num_sent = [0]
+        send_error = []
+        
+        # If the vectors aren't already contiguous float32, each mini-batch
+        # is converted into this buffer before it's sent. The sender reuses
+        # it for every batch, since each batch has been handed off to the
+        # socket by the time the next one is converted. (Vectors sent as 
+        # float16 are converted by 'pack_vectors' instead.)
+        if self.float16 or (vectors.dtype == np.float32 and 
+                            vectors.flags['C_CONTIGUOUS']):
+            scratch = None
+        else:
+            scratch = np.empty((min(batch_size, num_vecs), vectors.shape[1]),
+                               dtype=np.float32)
+        
+        def send_batches():
+            try:
+                # Construct the query request. Only the vectors change from 
+                # one mini-batch to the next, so the same request is re-used
+                # for all of them.
+                req = Request(
+                    api_key = self.api_key,
+                    command = _QUERY,
+                    k = k
+                )
+                
+                # For each mini-batch...
+                for start in starts:
+                    # Wait until there's room in the pipeline.
+                    window.acquire()
+                    if stop.is_set():
+                        return
+                    
+                    # Calculate the 'end' of this mini-batch.
+                    end = min(start + batch_size, num_vecs)
+
+                    # Select the vectors in this mini-batch. This is a 
+                    # view into 'vectors', not a copy.
+                    mini_batch = vectors[start:end, :]
+                    
+                    # Convert the mini-batch to contiguous float32 if needed.
+                    if scratch is not None:
+                        mini_batch = scratch[0:end - start]
+                        np.copyto(mini_batch, vectors[start:end, :], 
+                                  casting='unsafe')
+                    
+                    # Set the vectors as the request's payload.
+                    req.pack_vectors(mini_batch, float16=self.float16)
+                    
+                    # Submit the query (the response is received below).
+                    GpuClient.__sendall(self.sock, req.iov())
+                    num_sent[0] += 1
+                    
+            except Exception as e:
+                # If the receiver already closed the socket (after an error
+                # response), it is reporting that error instead.
+                if self.sock.fileno() == -1:
+                    return
+                
+                send_error.append(e)
+                
+                # Wake up the receiver, which would otherwise wait forever for
+                # the response to a request that was never sent.
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except (OSError, socket.error):
+                    pass
+        
+        sender = threading.Thread(target=send_batches)
+        sender.daemon = True
+        sender.start()
+        
+        num_received = 0
+        
+        # Time of the last progress update (or the start of the query).
+        last_progress = t0
+        
+        try:
+            # Receive the results for each mini-batch, in order.
+            for start in starts:
+                # Calculate the 'end' of this mini-batch.
+                end = min(start + batch_size, num_vecs)
+                
+                # Progress update. Batches can complete far faster than the
+                # updates can be read, so they're limited to one every 
+                # '_PROGRESS_INTERVAL' seconds rather than one per batch.
+                if verbose and not start == first and \
+                   time.time() - last_progress >= _PROGRESS_INTERVAL:
+                    last_progress = time.time()
+                    
                     # Caclulate the average throughput so far.
-                    queries_per_sec = ((time.time() - t0)  / start)
+                    queries_per_sec = ((last_progress - t0)  / (start - first))
                     
-                    # Estimate how much time (in seconds) is left to complete the 
-                    # test.
-                    time_est = queries_per_sec * (len(vectors) - start)
+                    # Estimate how much time (in seconds) is left to complete 
+                    # the test.
+                    time_est = queries_per_sec * (num_vecs - start)
                     
-                    # Format the estimated time remaining into minutes.
+                    # Format the progress line, giving the estimated time 
+                    # remaining in minutes if it's longer than 90 seconds.
+                    percent = (start * 100.0) / num_vecs
                     if time_est < 90:
-                        time_est_str = '~%.0f sec...' % time_est
+                        line = _PROGRESS_SEC % (start, num_vecs, percent, time_est)
                     else:
-                        time_est_str = '~%.0f min...' % (time_est / 60.0)
-    
-                    print('  Query %5d / %5d (%3.0f%%) Time Remaining: %s' % (start, len(vectors), float(start) / len(vectors) * 100.0, time_est_str))
+                        line = _PROGRESS_MIN % (start, num_vecs, percent, time_est / 60.0)
+
+                    print(line)
                     sys.stdout.flush()
                 
-                # Construct the query request.
-                req = Request(
-                    api_key = self.api_key,
-                    command = Command.QUERY,
-                    k = k
-                )
+                # Wait for the results of this mini-batch.
+                try:
+                    resp = self.__receive(reuse_body)
+                except Exception:
+                    # Report the original problem if the send failed.
+                    if send_error:
+                        raise send_error[0]
+                    raise
+                
+                num_received += 1
+                
+                # Let the sender submit another batch.
+                window.release()
                 
-                # Add the vectors.
-                req.pack_vectors(mini_batch)
-            
-                # Submit the query and wait for the results.
-                resp = self.__request(req)
-    
                 # Accumulate the total time spent on the server.
                 self.server_elapsed += resp.elapsed
                 
-                # Unpack the results and return them.
+                # Unpack the results.
                 D, I = resp.unpack_results()
                 
-                if not len(mini_batch) == I.shape[0]:
-                    print('ERROR: Mini batch length %d does not match results legnth %d!' % (len(mini_batch), I.shape[0]))
-                    sys.stdout.flush()
-                
-                # Accumulate the results.
-                D_all = np.concatenate((D_all, D))
-                I_all = np.concatenate((I_all, I))
+                if not (end - start) == I.shape[0]:
+                    raise IOError('Mini batch length %d does not match results length %d!' % (end - start, I.shape[0]))
                 
-                # Update the start pointer.
-                start = end
-    
-            # Store the total elapsed time from the client perspective.
-            self.client_elapsed = time.time() - t0
+                # Hand this batch of results to the caller.
+                yield start, D, I
+        
+        except GeneratorExit:
+            # The caller stopped iterating early. Stop sending, and receive
+            # (and discard) the responses which are still in flight so that
+            # the connection is ready for the next request.
+            stop.set()
+            window.release()
+            sender.join()
             
-            return D_all, I_all
+            if not send_error:
+                for i in range(num_sent[0] - num_received):
+                    self.__receive()
+            raise
         
-        # If vectors.ndim is not 1 or 2, then somethings wrong with it.
-        else:
-            raise IOError("'vectors' argument has wrong number of dimensions!")
+        except Exception:
+            # Any other error leaves the connection out of step with the 
+            # server: the responses to the batches still in flight haven't 
+            # been read (and after a corrupt header, where the next response
+            # starts isn't known). Close the connection, so that the next
+            # request can't receive one of these responses as its own.
+            stop.set()
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except (OSError, socket.error):
+                pass
+            window.release()
+            sender.join()
+            self.sock.close()
+            raise
+        
+        finally:
+            # Make sure the sender thread has finished.
+            stop.set()
+            window.release()
+            sender.join()
+
+        # Store the total elapsed time from the client perspective.
+        self.client_elapsed = time.time() - t0
     
+    def batch(self, k=10, batch_size=128):
+        """
+        Collect individual query vectors and submit them to the server 
+        together, rather than with one round trip per vector.
+        
+        A single query vector leaves most of the GPU idle and pays a full 
+        network round trip, so interactive sessions which look up many 
+        vectors one at a time are much faster when the lookups are grouped:
+        
+            with c.batch(k=10) as bq:
+                for vec in my_vectors:
+                    bq.submit(vec)
+            
+            distances, indeces = bq.distances, bq.indeces
+        
+        The collected vectors are submitted when the 'with' block exits, or
+        as soon as 'batch_size' of them are waiting. See 'QueryBatch'.
+        
+        :type k: int
+        :param k: The number of nearest neighbors to find.
+        
+        :type batch_size: int
+        :param batch_size: Number of query vectors to collect before 
+                           submitting them.
+        
+        :rtype: QueryBatch
+        :return: The batch to submit query vectors to.
+        """
+        return QueryBatch(self, k, batch_size)
+
     def query_from_file(self, file_name, dataset_name='', k=10, batch_size=1024):
         """
         Perform a batch query using query vectors stored in a file on the 
@@ -459,3 +1115,114 @@ class GpuClient:
             print("  Server Time: %0.1f min" % (self.server_elapsed / 60.0))
             print("     Overhead: %0.1f min" % ((self.client_elapsed - self.server_elapsed) / 60.0))
             print("        Total: %0.1f min" % (self.client_elapsed / 60.0))
+
+
+class QueryBatch:
+    """
+    Collects query vectors submitted one at a time, and sends them to the 
+    server in batches. Create one with 'GpuClient.batch'.
+    
+    The results are kept in submission order: 'submit' returns the row of 
+    'distances' and 'indeces' which holds the results for that vector.
+    """
+
+    def __init__(self, client, k=10, batch_size=128):
+        self.client = client
+        self.k = k
+        self.batch_size = batch_size
+        
+        # Query vectors waiting to be submitted.
+        self.pending = []
+        
+        # Total number of vectors added to the batch.
+        self.num_submitted = 0
+        
+        # Result matrices from each submitted batch, in order.
+        self._distances = []
+        self._indeces = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        """
+        Submit any remaining vectors on leaving the 'with' block, unless 
+        there was an exception.
+        """
+        if traceback is None:
+            self.flush()
+        
+        # Return False to re-raise any exception.
+        return False
+
+    def submit(self, vector):
+        """
+        Add a query vector to the batch.
+        
+        :type vector: numpy.ndarray
+        :param vector: A single query vector.
+        
+        :rtype: int
+        :return: The row of the results which will hold this vector's
+                 nearest neighbors.
+        """
+        
+        # The number of vectors submitted before this one.
+        row = self.num_submitted
+        
+        self.pending.append(vector)
+        self.num_submitted += 1
+        
+        # Send the batch once it's full.
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        
+        return row
+
+    def flush(self):
+        """
+        Submit all waiting query vectors to the server now.
+        """
+        if not self.pending:
+            return
+        
+        # Stack the vectors into a matrix and query them all at once.
+        D, I = self.client.query(np.stack(self.pending), k=self.k, 
+                                 batch_size=self.batch_size)
+        
+        self._distances.append(D)
+        self._indeces.append(I)
+        self.pending = []
+
+    def result(self, row):
+        """
+        Return the (distances, indeces) for the vector submitted as 'row'.
+        """
+        return self.distances[row], self.indeces[row]
+
+    @property
+    def distances(self):
+        """
+        Distances matrix for all submitted vectors, one row per vector.
+        """
+        self._merge()
+        return self._distances[0]
+
+    @property
+    def indeces(self):
+        """
+        Indeces matrix for all submitted vectors, one row per vector.
+        """
+        self._merge()
+        return self._indeces[0]
+
+    def _merge(self):
+        """
+        Combine the results of the submitted batches into single matrices.
+        """
+        if not self._indeces:
+            raise IOError("No query vectors have been submitted yet!")
+        
+        if len(self._indeces) > 1:
+            self._distances = [np.concatenate(self._distances)]
+            self._indeces = [np.concatenate(self._indeces)]